@@ -1,12 +1,32 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
 import csv
-import collections
+import os
+import sqlite3
+import sys
 
 
 GRAPHQL_URL = "https://api-consumer-client.doordash.com/graphql"
 
+# Minimum spacing between requests to DoorDash, in seconds
+MIN_REQUEST_INTERVAL = 1.0
+
+# Orders requested per GraphQL page unless overridden with --page-size
+DEFAULT_PAGE_SIZE = 20
+
+# Single SQLite file holding every cached API response, keyed by request
+CACHE_FILENAME = "doordash-cache.sqlite3"
+
+# Longest JSON dump written to the log when a response looks wrong
+MAX_LOGGED_JSON_CHARS = 2048
+
+# Buffer size for the CSV outputs, so rows are flushed in large writes
+CSV_BUFFER_SIZE = 1 << 20
+
+# Only select the fields execute() reads, so responses stay small to send and parse
 ORDERS_QUERY = """
     query getConsumerOrdersWithDetails($offset: Int!, $limit: Int!, $includeCancelled: Boolean, $orderFilterType: OrderFilterType) {
       getConsumerOrdersWithDetails(
@@ -20,30 +40,19 @@ ORDERS_QUERY = """
         createdAt
         submittedAt
         store {
-          id
           name
         }
         orders {
-          id
           creator {
-            id
             firstName
             lastName
           }
           items {
-            id
             name
-            quantity
-            specialInstructions
             orderItemExtras {
-              menuItemExtraId
               name
               orderItemExtraOptions {
-                menuExtraOptionId
                 name
-                description
-                price
-                quantity
               }
             }
           }
@@ -54,13 +63,48 @@ ORDERS_QUERY = """
 
 
 class DoorDashScraper:
-    def __init__(self, sessionid, verbose=False):
+    def __init__(self, sessionid, verbose=False, page_size=DEFAULT_PAGE_SIZE):
         if not sessionid:
             raise TypeError(
                 "You must provide a sessionid. Log into doordash.com in a web browser and copy your sessionid cookie."
             )
+        if page_size < 1:
+            raise ValueError(f"page_size must be at least 1, got {page_size}")
         self.sessionid = sessionid
         self.verbose = verbose
+        self.page_size = page_size
+
+        # One pooled session so every page reuses the same keep-alive TCP/TLS
+        # connection instead of doing a fresh handshake per request.
+        self.session = requests.Session()
+        self.session.headers.update({
+            "cookie": self.session_cookie(),
+            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "content-type": "application/json",
+            "accept": "*/*",
+            "origin": "https://www.doordash.com",
+            "referer": "https://www.doordash.com/consumer/order-history/"
+        })
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # The orders query is read-only, so retrying the POST is safe
+            allowed_methods=frozenset(["GET", "POST"]),
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self._next_request_at = 0.0
+
+        self.cache = sqlite3.connect(CACHE_FILENAME)
+        self.cache.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB NOT NULL)"
+        )
+
+    def close(self):
+        """Releases the pooled HTTP connections and the cache database handle."""
+        self.session.close()
+        self.cache.close()
 
     def session_cookie(self):
         # If the sessionid already contains semicolons, it's a full cookie string
@@ -72,6 +116,40 @@ class DoorDashScraper:
     def log(self, *args, **kwargs):
         print(f"{time.ctime()}  ", *args, **kwargs)
 
+    def log_json(self, label, data):
+        """Logs data as compact JSON, cut off after MAX_LOGGED_JSON_CHARS."""
+        text = json.dumps(data)
+        if len(text) > MAX_LOGGED_JSON_CHARS:
+            text = f"{text[:MAX_LOGGED_JSON_CHARS]}... ({len(text)} characters total)"
+        self.log(f"{label}: {text}")
+
+    def throttle(self):
+        """Blocks until another request is allowed. Requests are spaced from
+        when the previous one was sent rather than when it finished, so the
+        wait overlaps with network time instead of adding to it."""
+        now = time.monotonic()
+        if now < self._next_request_at:
+            time.sleep(self._next_request_at - now)
+            now = self._next_request_at
+        self._next_request_at = now + MIN_REQUEST_INTERVAL
+
+    def load_persisted(self, key):
+        """Returns the cached response for key, or None if it isn't cached."""
+        row = self.cache.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def persist(self, key, data):
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        with self.cache:
+            self.cache.execute(
+                "INSERT OR REPLACE INTO responses (key, body) VALUES (?, ?)", (key, body)
+            )
+
     def fetch_orders(self, limit, offset):
         """Fetches one batch of orders, containing basic things like the date
         and store name but not a complete itemized receipt."""
@@ -82,31 +160,25 @@ class DoorDashScraper:
             "orderFilterType": None
         }
         body = {"query": ORDERS_QUERY, "variables": variables, "operationName": "getConsumerOrdersWithDetails"}
-        headers = {
-            "cookie": self.session_cookie(),
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "content-type": "application/json",
-            "accept": "*/*",
-            "origin": "https://www.doordash.com",
-            "referer": "https://www.doordash.com/consumer/order-history/"
-        }
-        r = requests.post(url=GRAPHQL_URL, json=body, headers=headers)
-        data = json.loads(r.text)
+        self.throttle()
+        r = self.session.post(url=GRAPHQL_URL, json=body)
+        # Parse the raw bytes directly; going through r.text would decode the
+        # whole body into a second str copy first.
+        data = json.loads(r.content)
         return data
 
     def fetch_orders_persisted(self, limit, offset):
-        filename = f"doordash-orders-limit-{limit}-offset-{offset}.json"
-        try:
-            data = json.load(open(filename, "r"))
+        key = f"orders-limit-{limit}-offset-{offset}"
+        data = self.load_persisted(key)
+        if data is not None:
             return data, True
-        except (IOError, ValueError):
-            data = self.fetch_orders(limit, offset)
-            json.dump(data, open(filename, "w"))
-            return data, False
+        data = self.fetch_orders(limit, offset)
+        self.persist(key, data)
+        return data, False
 
     def fetch_all_orders(self):
         """Fetches all orders in a loop."""
-        limit = 20
+        limit = self.page_size
         offset = 0
         self.log(f"Fetching all order summaries in batches of {limit}")
         while True:
@@ -122,7 +194,7 @@ class DoorDashScraper:
                 error_msg = data["errors"][0]["message"] if data["errors"] else "Unknown error"
                 self.log(f"API Error: {error_msg}")
                 if self.verbose:
-                    self.log(f"Full response: {json.dumps(data, indent=2)}")
+                    self.log_json("Errors", data["errors"])
                 if "getConsumerOrdersWithDetails" in error_msg or "ordersHistory" in error_msg:
                     raise RuntimeError(
                         "DoorDash changed their order history GraphQL query. "
@@ -135,7 +207,7 @@ class DoorDashScraper:
             if "data" not in data:
                 self.log(f"Unexpected response structure. Response keys: {list(data.keys())}")
                 if self.verbose:
-                    self.log(f"Full response: {json.dumps(data, indent=2)}")
+                    self.log_json("Response", data)
                 raise RuntimeError(f"Unexpected API response structure. Expected 'data' key but got: {list(data.keys())}")
             
             orders_history = data["data"].get("getConsumerOrdersWithDetails")
@@ -146,7 +218,7 @@ class DoorDashScraper:
                     "DoorDash likely changed the API again."
                 )
                 if self.verbose:
-                    self.log(f"Full response: {json.dumps(data, indent=2)}")
+                    self.log_json("Response", data)
                 raise RuntimeError(
                     "DoorDash response did not include 'getConsumerOrdersWithDetails'. Update ORDERS_QUERY to match the current API."
                 )
@@ -154,127 +226,124 @@ class DoorDashScraper:
                 self.log("Got an empty batch, so we're done fetching order summaries!")
                 break
             yield from orders_history
-            offset += limit
-            if not was_persisted:
-                time.sleep(1)
-
-    def fetch_receipt(self, order_id):
-        """Fetches one full receipt which contains all the items that each person
-        ordered. (DEPRECATED - no longer used with new API)"""
-        url = (
-            f"https://api.doordash.com/v2/order_carts/{order_id}/?expand=store_order_carts&expand=store_order_carts.%5Bdelivery%2Cstore%5D&expand=store_order_carts.store.business&expand=store_order_carts.orders.%5Bconsumer%5D&expand=store_order_carts.orders.order_items.%5Bitem%2Coptions%5D&expand=store_order_carts.orders.order_items.options.item_extra_option.item_extra&extra=is_group%2Csubtotal%2Ctax_amount%2Cdiscount_amount%2Cservice_fee%2Cdelivery_fee%2Cextra_sos_delivery_fee%2Cmin_order_fee%2Cmin_order_subtotal%2Cmin_age_requirement%2Cpromotions%2Cstore_order_carts%2Cdelivery_availability%2Ctip_suggestions%2Ccancelled_at%2Ctotal_charged%2Cis_pre_tippable%2Chide_sales_tax&extra=store_order_carts.%5Borders%2Cdelivery%2Ctip_amount%5D&extra=store_order_carts.orders.dd4b_expense_code&extra=store_order_carts.store.business&extra=store_order_carts.store.business.id&extra=store_order_carts.store.phone_number&extra=store_order_carts.delivery.%5Bstatus%2Cdelivery_address%2Cpickup_address%2Cdasher_approaching_customer_time%2Cdasher_at_store_time%2Cdasher_confirmed_time%2Cstore_confirmed_time%2Cdasher_location_available%2Cdasher_route_available%2Cshow_dynamic_eta%2Cdasher%2Cis_consumer_pickup%2Cis_ready_for_consumer_pickup%2Cfulfillment_type%2Chas_external_courier_tracking%2Cconsumer_poc_number%5D&extra=store_order_carts.delivery.pickup_address.id&extra=store_order_carts.delivery.pickup_address.address.printable_address&extra=store_order_carts.delivery.delivery_address.address.printable_address&extra=store_order_carts.orders.order_items&extra=store_order_carts.orders.order_items.%5Bid%2Cunit_price%2Cquantity%2Citem%2Csubstitution_preference%2Cspecial_instructions%2Coptions%5D&extra=store_order_carts.orders.order_items.options.%5Bid%2Citem_extra_option%5D&extra=store_order_carts.orders.order_items.options.item_extra_option.%5Bname%2Cdescription%2Cid%2Citem_extra%5D&extra=store_order_carts.orders.order_items.options.item_extra_option.item_extra.name&extra=store_order_carts.orders.order_items.item.%5Bname%2Cid%2Cprice%5D"
-        )
-        headers = {
-            "cookie": self.session_cookie(),
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        r = requests.get(url, headers=headers)
-        data = json.loads(r.text)
-        return data
-
-    def fetch_receipt_persisted(self, order_id):
-        filename = f"doordash-receipt-id-{order_id}.json"
-        try:
-            data = json.load(open(filename, "r"))
-            return data, True
-        except (IOError, ValueError):
-            data = self.fetch_receipt(order_id)
-            json.dump(data, open(filename, "w"))
-            return data, False
+            # Advance by what actually came back: DoorDash may silently cap the
+            # page size, and stepping by limit would then skip orders
+            offset += len(orders_history)
 
     def execute(self):
-        rows = []
-        for index, order_cart in enumerate(self.fetch_all_orders()):
-            store_name = order_cart["store"]["name"]
-            delivery_time = order_cart.get("submittedAt") or order_cart.get("createdAt")
-            order_id = order_cart["orderUuid"] or order_cart["id"]
+        # Pivot cells are keyed by each person's index, not their name; the
+        # name -> index map and the per-person counts are kept alongside.
+        by_order_id = {}
+        order_details = {}
+        person_index = {}
+        person_counter = []
+
+        # Write CSV while orders are fetched. Only the pivot has to wait, since
+        # its columns are every person seen across all orders. Rows go to a
+        # temporary file that only replaces the real one once fetching has
+        # finished, so a failed run (e.g. an expired cookie) keeps the old CSV.
+        filename = "doordash.csv"
+        temp_filename = f"{filename}.tmp"
+        self.log("Writing normal CSV", filename)
+        with open(temp_filename, "w", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Date", "Store", "Person", "Item", "Options"])
+            for index, order_cart in enumerate(self.fetch_all_orders()):
+                store_name = order_cart["store"]["name"]
+                delivery_time = order_cart.get("submittedAt") or order_cart.get("createdAt")
+                order_id = order_cart["orderUuid"] or order_cart["id"]
             
-            # Validate that we have a timestamp, use default if missing
-            if not delivery_time:
-                self.log(f"Warning: Order {order_id} missing timestamp, using placeholder date")
-                delivery_time = "1900-01-01T00:00:00Z"  # Sentinel date that parses correctly
+                # Validate that we have a timestamp, use default if missing
+                if not delivery_time:
+                    self.log(f"Warning: Order {order_id} missing timestamp, using placeholder date")
+                    delivery_time = "1900-01-01T00:00:00Z"  # Sentinel date that parses correctly
+                date = delivery_time[:10]
             
-            if self.verbose:
-                self.log(f"Processing order {order_id} from {store_name} ({index})")
+                if self.verbose:
+                    self.log(f"Processing order {order_id} from {store_name} ({index})")
+                # These are held for every order until the pivot is written, and
+                # the same few stores and days repeat, so share one copy of each.
+                # A null store name is kept as-is and written as an empty cell.
+                if isinstance(store_name, str):
+                    store_name = sys.intern(store_name)
+                details = (sys.intern(date), store_name)
+                # Looked up on the cart's first item, so orders only get a pivot
+                # row (and its position) once they actually have an item
+                cells_by_person = None
             
-            # Process each sub-order (for group orders)
-            for sub_order in order_cart["orders"]:
-                creator = sub_order.get("creator")
-                if creator:
-                    first_name = creator.get("firstName") or "Unknown"
-                    last_name = creator.get("lastName") or ""
-                    person_name = f"{first_name} {last_name}".strip()
-                else:
-                    person_name = "Unknown"
+                # Process each sub-order (for group orders)
+                for sub_order in order_cart["orders"]:
+                    creator = sub_order.get("creator")
+                    if creator:
+                        first_name = creator.get("firstName") or "Unknown"
+                        last_name = creator.get("lastName") or ""
+                        person_name = f"{first_name} {last_name}".strip()
+                    else:
+                        person_name = "Unknown"
+                    if not sub_order["items"]:
+                        continue  # Only people with items get a pivot column
+                    person = person_index.get(person_name)
+                    if person is None:
+                        person = person_index[person_name] = len(person_counter)
+                        person_counter.append(0)
                 
-                # Process each item in the order
-                for item in sub_order["items"]:
-                    item_name = item["name"]
-                    options = []
-                    
-                    # Process item extras (options/modifiers)
-                    for extra in item.get("orderItemExtras", []):
-                        extra_name = extra["name"]
-                        for extra_option in extra.get("orderItemExtraOptions", []):
-                            option_name = extra_option["name"]
-                            options.append((extra_name, option_name))
-                    
-                    option_strings = [f"{name}: {value}" for name, value in options]
-                    options_string = ", ".join(option_strings)
+                    # Process each item in the order
+                    for item in sub_order["items"]:
+                        item_name = item["name"]
+
+                        # Process item extras (options/modifiers). The "Extra: "
+                        # prefix is built once per extra, not once per option.
+                        option_strings = []
+                        for extra in item.get("orderItemExtras", ()):
+                            prefix = f"{extra['name']}: "
+                            for extra_option in extra.get("orderItemExtraOptions", ()):
+                                option_strings.append(f"{prefix}{extra_option['name']}")
+                        options_string = ", ".join(option_strings)
                     
-                    row = {
-                        "order_id": order_id,
-                        "date": delivery_time,
-                        "store": store_name,
-                        "person": person_name,
-                        "item": item_name,
-                        "options": options_string,
-                    }
-                    rows.append(row)
-            
-            time.sleep(0.1)  # Rate limiting
+                        writer.writerow([date, store_name, person_name, item_name, options_string])
 
-        # Write CSV
-        filename = "doordash.csv"
-        self.log("Writing normal CSV", filename)
-        with open(filename, "w") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["Date", "Store", "Person", "Item", "Options"])
-            for row in rows:
-                writer.writerow(
-                    [
-                        row["date"][:10],
-                        row["store"],
-                        row["person"],
-                        row["item"],
-                        row["options"],
-                    ]
-                )
+                        if cells_by_person is None:
+                            cells_by_person = by_order_id.get(order_id)
+                            if cells_by_person is None:
+                                cells_by_person = by_order_id[order_id] = {}
+                            order_details[order_id] = details
+                        cells_by_person[person] = f"{item_name}. {options_string}"
+                        person_counter[person] += 1
+        os.replace(temp_filename, filename)
 
         # Write pivoted CSV
         filename = "doordash-pivot.csv"
         self.log("Writing pivoted CSV", filename)
-        by_order_id = collections.defaultdict(dict)
-        for row in rows:
-            order = by_order_id[row["order_id"]]
-            order["date"] = row["date"]
-            order["store"] = row["store"]
-            order[row["person"]] = f"{row['item']}. {row['options']}"
-        person_counter = collections.Counter()
-        for row in rows:
-            person_counter[row["person"]] += 1
-        people = [person for person, _count in person_counter.most_common()]
-        with open(filename, "w") as csvfile:
+        # Most frequent first; sorted() is stable, so ties keep first-seen order
+        ranking = sorted(range(len(person_counter)), key=person_counter.__getitem__, reverse=True)
+        names = list(person_index)
+        people = [names[person] for person in ranking]
+        column_of = [0] * len(ranking)
+        for column, person in enumerate(ranking):
+            column_of[person] = column
+
+        def pivot_rows():
+            for order_id, cells_by_person in by_order_id.items():
+                cells = [""] * len(people)
+                for person, cell in cells_by_person.items():
+                    cells[column_of[person]] = cell
+                yield [*order_details[order_id], *cells]
+
+        with open(filename, "w", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE) as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(["Date", "Store"] + people)
-            for row in by_order_id.values():
-                people_values = [row.get(person, "") for person in people]
-                writer.writerow([row["date"][:10], row["store"]] + people_values)
+            writer.writerows(pivot_rows())
 
 
 if __name__ == "__main__":
     import argparse
 
+    def page_size(value):
+        size = int(value)
+        if size < 1:
+            raise argparse.ArgumentTypeError(f"must be at least 1, got {size}")
+        return size
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "sessionid",
@@ -283,8 +352,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "-v", "--verbose", help="show more detailed logs", action="store_true"
     )
+    parser.add_argument(
+        "--page-size",
+        help=f"orders to request per API call (default: {DEFAULT_PAGE_SIZE}); larger pages mean fewer round-trips",
+        type=page_size,
+        default=DEFAULT_PAGE_SIZE,
+    )
     args = parser.parse_args()
     print(args.sessionid)
 
-    scraper = DoorDashScraper(args.sessionid, args.verbose)
-    scraper.execute()
+    scraper = DoorDashScraper(args.sessionid, args.verbose, args.page_size)
+    try:
+        scraper.execute()
+    finally:
+        scraper.close()
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from doordash_scraper import DoorDashScraper
+
+
+class FetchAllOrdersTest(unittest.TestCase):
+    def setUp(self):
+        # The scraper keeps its response cache in the working directory
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmpdir.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_server_capped_page_size_fetches_every_order(self):
+        orders = [{"id": str(i)} for i in range(100)]
+
+        def fetch_orders(limit, offset):
+            # Server silently returns at most 20 orders, whatever limit is asked for
+            page = orders[offset:offset + min(limit, 20)]
+            return {"data": {"getConsumerOrdersWithDetails": page}}
+
+        scraper = DoorDashScraper("sessionid", page_size=50)
+        self.addCleanup(scraper.close)
+        with mock.patch.object(scraper, "fetch_orders", side_effect=fetch_orders), mock.patch("builtins.print"):
+            fetched = list(scraper.fetch_all_orders())
+
+        self.assertEqual(fetched, orders)
+
+
+if __name__ == "__main__":
+    unittest.main()